@@ -1,42 +1,169 @@
+import argparse
+import json
 import os
+import shutil
 import subprocess
-from dotenv import load_dotenv
-
-# Load environment variables from .env file
-load_dotenv()
+import sys
+import tarfile
+import tempfile
+import threading
+from pg_common import (
+    EXCLUDED_SCHEMAS, INCREMENTAL_MANIFEST, PG_RESTORE_PATH, PIGZ_PATH, PSQL_PATH, RESTORE_SINGLE_TRANSACTION,
+    build_env, connection_args, decode_tail, find_pg_tool,
+)
 
 # --- Configuration ---
 # Set the default file to restore based on the last successful attempt
-DEFAULT_RESTORE_FILE = "full_backup_20251125_000420.sql"
+DEFAULT_RESTORE_FILE = "full_backup_20251125_000420.dir"
+# Session settings applied before replaying a plain SQL dump: skip the per-commit
+# WAL flush and give index builds and sorts more memory.
+RESTORE_PRELUDE = (
+    "SET synchronous_commit = off; "
+    "SET maintenance_work_mem = '1GB'; "
+    "SET work_mem = '256MB'; "
+    "SET client_min_messages = warning;"
+)
+# Optional restore_command for replaying archived WAL on top of a physical backup,
+# e.g. 'wal-g wal-fetch %f %p'
+WAL_RESTORE_COMMAND = os.getenv('WAL_RESTORE_COMMAND')
 # --- End Configuration ---
 
+# Resolved once at import instead of probing the filesystem on every call
+PG_COMBINEBACKUP_PATH = find_pg_tool('pg_combinebackup')
+# Reject absolute paths and links outside the target where tarfile supports it
+TAR_EXTRACT_KWARGS = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+
 def get_config():
     """Load configuration from .env and validate."""
     host = os.getenv('DB_HOST')
     port = os.getenv('DB_PORT', '6543')
     user = os.getenv('DB_USER')
     password = os.getenv('PASS')
+    sslmode = os.getenv('PGSSLMODE', 'require')
+    # Kill the restore if it runs longer than this many seconds (0 = no limit).
+    # Multi-GB restores routinely take longer than a few minutes.
+    timeout = os.getenv('RESTORE_TIMEOUT', '').strip()
+    # Parallel pg_restore connections for .dir/.dump archives; defaults to the CPU count
+    jobs = os.getenv('RESTORE_JOBS', '').strip()
     
     if not host or not user or not password:
         print("❌ Configuration Error: Missing DB_HOST, DB_USER, or PASS in .env file.")
         return None
+
+    if timeout and not timeout.isdigit():
+        print("❌ Configuration Error: RESTORE_TIMEOUT must be a whole number of seconds (0 = no limit).")
+        return None
+
+    if jobs and not jobs.isdigit():
+        print("❌ Configuration Error: RESTORE_JOBS must be a whole number (0 = CPU count).")
+        return None
         
     return {
         'host': host,
         'port': port,
         'user': user,
-        'password': password
+        'password': password,
+        'sslmode': sslmode,
+        'timeout': int(timeout or 0) or None,
+        'jobs': int(jobs or 0) or os.cpu_count() or 1,
     }
 
-def restore_supabase_data():
-    """Restores a SQL file to the Supabase database using psql."""
+def user_objects_query(catalog, namespace_column, deptypes="'e'", condition='TRUE'):
+    """Return SQL testing whether schema n has objects in catalog not owned by an extension."""
+    return (
+        f"EXISTS (SELECT 1 FROM pg_catalog.{catalog} o WHERE o.{namespace_column} = n.oid AND {condition} "
+        f"AND NOT EXISTS (SELECT 1 FROM pg_depend d WHERE d.classid = 'pg_catalog.{catalog}'::regclass "
+        f"AND d.objid = o.oid AND d.deptype IN ({deptypes})))"
+    )
+
+# Schemas holding anything a dump would CREATE: relations, types (row and array
+# types are internal to another object and skipped) and functions
+NON_EMPTY_SCHEMAS_QUERY = (
+    "SELECT n.nspname FROM pg_namespace n "
+    "WHERE n.nspname NOT LIKE 'pg\\_%' AND n.nspname <> 'information_schema' AND ("
+    + user_objects_query('pg_class', 'relnamespace', condition="o.relkind IN ('r', 'p', 'v', 'm', 'S', 'f')")
+    + " OR " + user_objects_query('pg_type', 'typnamespace', deptypes="'e', 'i'")
+    + " OR " + user_objects_query('pg_proc', 'pronamespace')
+    + ")"
+)
+
+def is_target_empty(config, env):
+    """Return True if the target database has no user objects in any schema the backup covers.
+
+    Relations, types, domains and functions count. System schemas and
+    EXCLUDED_SCHEMAS are ignored, as are objects created by extensions, which a
+    fresh Supabase database already has in schemas such as extensions and
+    graphql. Any failure to check counts as not empty, so the restore keeps its
+    DROP statements.
+    """
+    cmd = [
+        PSQL_PATH,
+        *connection_args(config),
+        '--tuples-only',
+        '--no-align',
+        f'--command={NON_EMPTY_SCHEMAS_QUERY}',
+    ]
+    try:
+        result = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    if result.returncode != 0:
+        return False
+    schemas = result.stdout.decode('utf-8', 'replace').splitlines()
+    return all(schema in EXCLUDED_SCHEMAS for schema in schemas)
+
+def copy_without_clean(source, dest):
+    """Copy a plain SQL dump made with --clean to dest, leaving out its DROP statements.
+
+    pg_dump writes all DROP statements before its first CREATE or COPY. A joined
+    --per-schema dump holds several pg_dump outputs, so filtering starts again
+    after each "dump complete" trailer. Lines between `COPY ... FROM stdin;` and
+    its `\\.` terminator are table data and are always copied unchanged.
+    DROP SCHEMA/EXTENSION are kept since those objects exist even in a fresh
+    Supabase database.
+    """
+    try:
+        in_prologue = True
+        in_copy = False
+        for line in source:
+            if in_copy:
+                in_copy = line.rstrip(b'\r\n') != b'\\.'
+            elif line.startswith(b'COPY ') and line.rstrip().endswith(b'FROM stdin;'):
+                in_copy = True
+                in_prologue = False
+            elif in_prologue:
+                if line.startswith(b'CREATE '):
+                    in_prologue = False
+                else:
+                    is_drop = line.startswith(b'DROP ') or (line.startswith(b'ALTER ') and b' DROP ' in line)
+                    if is_drop and not line.startswith((b'DROP SCHEMA ', b'DROP EXTENSION ')):
+                        continue
+            elif line.startswith(b'-- PostgreSQL database dump complete'):
+                in_prologue = True
+            dest.write(line)
+    except BrokenPipeError:
+        pass  # psql exited early; its own output explains why
+    finally:
+        try:
+            dest.close()
+        except BrokenPipeError:
+            pass
+
+def restore_supabase_data(restore_file=None, assume_yes=False, always_clean=False):
+    """Restores a SQL file (via psql, gunzipped on the fly) or a directory/custom archive (via pg_restore) to the Supabase database.
+
+    Without `restore_file` the user is prompted for one; `assume_yes` skips the
+    confirmation prompt so the restore can run unattended. When the target has
+    no tables yet, the DROP statements are skipped unless `always_clean` is set.
+    """
     
     config = get_config()
     if not config:
         return
 
     # Prompt user for the file name to ensure they select the right one
-    restore_file = input(f"Enter the backup file to restore (default: {DEFAULT_RESTORE_FILE}): ").strip()
+    if not restore_file:
+        restore_file = input(f"Enter the backup file to restore (default: {DEFAULT_RESTORE_FILE}): ").strip()
     if not restore_file:
         restore_file = DEFAULT_RESTORE_FILE
 
@@ -48,7 +175,7 @@ def restore_supabase_data():
     print("⚠️ WARNING: This operation will OVERWRITE existing data!")
     print("=======================================================")
     
-    confirm = input("Type 'YES' to proceed with the database RESTORE: ")
+    confirm = 'YES' if assume_yes else input("Type 'YES' to proceed with the database RESTORE: ")
     if confirm.upper() != 'YES':
         print("Restore cancelled by user.")
         return
@@ -56,53 +183,230 @@ def restore_supabase_data():
     print(f"\n🚀 Restoring {restore_file} to Supabase...")
     print(f"Connecting to Host: {config['host']}")
     
-    # 1. Define psql path
-    # Try to use the full path you had before, but fallback to 'psql' if not found
-    psql_path = '/opt/homebrew/opt/postgresql@15/bin/psql'
-    if not os.path.exists(psql_path):
-        psql_path = 'psql'
+    # 1. Pick the restore tool: directory (.dir) and custom (.dump) archives go
+    # through pg_restore (in parallel), plain SQL files (optionally .sql.gz) through psql.
+    if os.path.isdir(restore_file) or restore_file.endswith(('.dir', '.dump')):
+        tool = 'pg_restore'
+    else:
+        tool = 'psql'
+    tool_path = PG_RESTORE_PATH if tool == 'pg_restore' else PSQL_PATH
         
-    # 2. Base command structure for psql
-    cmd = [
-        psql_path,
-        f'--host={config["host"]}',
-        f'--port={config["port"]}',
-        f'--username={config["user"]}',
-        '--dbname=postgres',
-        '--file=' + restore_file,
-        '--echo-errors', # Show any SQL errors encountered
-        '--quiet'        # Suppress command output, only show errors
-    ]
+    compressed = restore_file.endswith('.gz')
     
-    # 3. Set PGPASSWORD environment variable
-    env = os.environ.copy()
-    env['PGPASSWORD'] = config['password']
+    # 2. Minimal environment carrying PGPASSWORD
+    env = build_env(config, 'db_restore')
     
-    # 4. Execute
+    # 3. An empty target has nothing to drop, so skip one DROP round-trip per object
+    skip_clean = not always_clean and is_target_empty(config, env)
+    if skip_clean:
+        print("Target database has no user objects yet, skipping DROP statements.")
+    # Plain dumps are filtered on their way into psql's stdin
+    strip_clean = skip_clean and tool == 'psql'
+        
+    # 4. Base command structure
+    if tool == 'pg_restore':
+        cmd = [
+            tool_path,
+            *connection_args(config),
+            '--no-owner',      # Prevents ownership errors on restore
+            '--no-privileges', # Prevents grant errors on restore
+            '--verbose',       # Report each item as it's restored
+        ]
+        if not skip_clean:
+            cmd.append('--clean')      # Drop objects before recreating them
+            cmd.append('--if-exists')  # Only use IF EXISTS with DROP
+        # Parallel jobs each use their own connection, so they can't share a transaction
+        if RESTORE_SINGLE_TRANSACTION:
+            cmd.append('--single-transaction')
+        elif config['jobs'] > 1:
+            cmd.append(f'--jobs={config["jobs"]}')
+        cmd.append(restore_file)
+    else:
+        cmd = [
+            tool_path,
+            *connection_args(config),
+            # psql runs --command and --file in order, in the same session
+            f'--command={RESTORE_PRELUDE}',
+            # Compressed or filtered dumps are read from stdin
+            '--file=' + ('-' if compressed or strip_clean else restore_file),
+            f'--output={os.devnull}',   # Discard query results such as set_config() rows
+            '--echo-errors', # Show any SQL errors encountered
+            '--quiet'        # Suppress command output, only show errors
+        ]
+        if RESTORE_SINGLE_TRANSACTION:
+            cmd.append('--single-transaction')   # One commit for the whole dump
+            cmd.append('--set=ON_ERROR_STOP=1')  # Roll back on the first error instead of half-restoring
+    
+    # 5. Execute
+    decompressor = None
+    source = None
     try:
-        # Use a timeout for safety, restoring large files can take time
-        result = subprocess.run(cmd, env=env, capture_output=True, text=True, timeout=300) 
+        stdin = None
+        if compressed:
+            decompress_cmd = [PIGZ_PATH, '-dc'] if PIGZ_PATH else ['gzip', '-dc']
+            decompressor = subprocess.Popen(decompress_cmd + [restore_file], stdout=subprocess.PIPE)
+            stdin = decompressor.stdout
+        if strip_clean:
+            source = stdin or open(restore_file, 'rb')
+            stdin = subprocess.PIPE
+
+        # Stream progress and errors as they arrive; memory use stays constant
+        # however long the restore log gets.
+        proc = subprocess.Popen(cmd, env=env, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        feeder = None
+        if strip_clean:
+            feeder = threading.Thread(target=copy_without_clean, args=(source, proc.stdin), daemon=True)
+            feeder.start()
+        # Optional timeout (RESTORE_TIMEOUT), restoring large files can take time
+        timed_out = threading.Event()
+        def kill_on_timeout():
+            timed_out.set()
+            proc.kill()
+        timer = None
+        if config['timeout']:
+            timer = threading.Timer(config['timeout'], kill_on_timeout)
+            timer.start()
+        line_count = 0
+        wrong_password = False
+        try:
+            for line in proc.stdout:
+                if line_count == 0:
+                    print(f"--- Output from {tool} ---")
+                line_count += 1
+                wrong_password = wrong_password or b'Wrong password' in line or b'password authentication failed' in line
+                sys.stdout.write(line.decode('utf-8', errors='replace'))
+                sys.stdout.flush()
+            returncode = proc.wait()
+            if feeder:
+                feeder.join()
+        finally:
+            if timer:
+                timer.cancel()
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(cmd, config['timeout'])
+        if line_count:
+            print("---------------------------------------")
+        
+        if decompressor:
+            decompressor.stdout.close()
+            if decompressor.wait() != 0 and returncode == 0:
+                returncode = decompressor.returncode
+                print(f"❌ Decompressing {restore_file} failed with code {decompressor.returncode}")
         
-        if result.returncode == 0:
+        if returncode == 0:
             print(f"\n✅ RESTORE COMPLETE! Database restored from {restore_file}.")
         else:
-            print(f"\n❌ psql failed: Restore attempt failed with return code {result.returncode}.")
-            print("--- Output from psql (Errors Only) ---")
-            # psql sends errors to stdout and stderr, print both for debugging
-            if result.stdout:
-                print(result.stdout.strip())
-            if result.stderr:
-                print(result.stderr.strip())
-            print("---------------------------------------")
-            print("💡 Hint: If you see a 'Wrong password' error, reset the password and update .env.")
+            print(f"\n❌ {tool} failed: Restore attempt failed with return code {returncode}.")
+            if wrong_password:
+                print("💡 Hint: Password is incorrect. Reset the password and update 'PASS' in .env.")
 
     except FileNotFoundError:
-        print(f"❌ Could not find psql at: {psql_path}")
+        print(f"❌ Could not find {tool} at: {tool_path}")
         print("   Ensure PostgreSQL client tools are installed (e.g., brew install postgresql).")
     except subprocess.TimeoutExpired:
-        print("❌ Restore timed out after 300 seconds (5 minutes). The file may be too large or the connection too slow.")
+        print(f"❌ Restore timed out after {config['timeout']} seconds. The file may be too large or the connection too slow.")
     except Exception as e:
         print(f"❌ An unexpected error occurred: {e}")
+    finally:
+        if source and not decompressor:
+            source.close()
+        if decompressor and decompressor.poll() is None:
+            decompressor.kill()
+
+def extract_physical_backup(backup_dir, target_dir):
+    """Unpack a tar-format pg_basebackup (base.tar.gz + pg_wal.tar.gz) into target_dir."""
+    os.makedirs(target_dir, mode=0o700, exist_ok=True)
+    for archive, subdir in (('base.tar.gz', ''), ('pg_wal.tar.gz', 'pg_wal')):
+        path = os.path.join(backup_dir, archive)
+        if os.path.exists(path):
+            with tarfile.open(path) as tar:
+                tar.extractall(os.path.join(target_dir, subdir), **TAR_EXTRACT_KWARGS)
+    # pg_combinebackup reads the manifest from the data directory
+    manifest = os.path.join(backup_dir, 'backup_manifest')
+    if os.path.exists(manifest):
+        shutil.copy(manifest, target_dir)
+
+def restore_incremental_backup(base_dir, target_dir, week=None):
+    """Rebuild a data directory from a weekly base backup plus its incrementals.
+
+    The backups are unpacked and, if there are incrementals, merged with
+    pg_combinebackup. When WAL_RESTORE_COMMAND is set, the data directory is
+    also put into recovery mode so PostgreSQL replays archived WAL on startup.
+    """
+    manifest_path = os.path.join(base_dir, INCREMENTAL_MANIFEST)
+    if not os.path.exists(manifest_path):
+        print(f"❌ No incremental backup manifest found in: {base_dir}")
+        return False
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    week = week or max(manifest, default=None)
+    if week not in manifest:
+        print(f"❌ No base backup recorded for week: {week}")
+        return False
+    if os.path.isdir(target_dir) and os.listdir(target_dir):
+        print(f"❌ Target data directory is not empty: {target_dir}")
+        return False
+
+    chain = [manifest[week]['base']] + manifest[week]['incremental']
+    backup_dirs = [os.path.join(base_dir, entry['path']) for entry in chain]
+    print(f"\n🚀 Restoring week {week} ({len(chain)} backups, up to LSN {chain[-1]['start_lsn']}) into {target_dir}")
+
+    try:
+        if len(backup_dirs) == 1:
+            extract_physical_backup(backup_dirs[0], target_dir)
+        else:
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(target_dir))) as work_dir:
+                unpacked = []
+                for i, backup_dir in enumerate(backup_dirs):
+                    unpacked.append(os.path.join(work_dir, str(i)))
+                    extract_physical_backup(backup_dir, unpacked[-1])
+                cmd = [PG_COMBINEBACKUP_PATH, *unpacked, f'--output={target_dir}']
+                result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                if result.returncode != 0:
+                    print(f"❌ pg_combinebackup failed: {decode_tail(result.stderr)}")
+                    return False
+            # The WAL streamed with the newest backup makes it consistent on startup
+            with tarfile.open(os.path.join(backup_dirs[-1], 'pg_wal.tar.gz')) as tar:
+                tar.extractall(os.path.join(target_dir, 'pg_wal'), **TAR_EXTRACT_KWARGS)
+    except FileNotFoundError as e:
+        print(f"❌ Could not restore physical backup: {e}")
+        return False
+
+    # PostgreSQL refuses to start on a data directory other users can read
+    os.chmod(target_dir, 0o700)
+
+    if WAL_RESTORE_COMMAND:
+        # Quotes inside a postgresql.conf string are escaped by doubling them
+        restore_command = WAL_RESTORE_COMMAND.replace("'", "''")
+        with open(os.path.join(target_dir, 'postgresql.auto.conf'), 'a') as f:
+            f.write(f"restore_command = '{restore_command}'\n")
+        open(os.path.join(target_dir, 'recovery.signal'), 'w').close()
+
+    print(f"\n✅ RESTORE COMPLETE! Start PostgreSQL with: pg_ctl -D {target_dir} start")
+    return True
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Restore a Supabase backup.")
+    parser.add_argument('file', nargs='?',
+                        help="Backup file or directory to restore (prompted for if omitted).")
+    parser.add_argument('--yes', action='store_true',
+                        help="Skip the overwrite confirmation prompt.")
+    parser.add_argument('--always-clean', action='store_true',
+                        help="Run the dump's DROP statements even when the target has no tables.")
+    parser.add_argument('--incremental', metavar='BASE_DIR',
+                        help="Restore a physical backup taken with direct_backup.py --incremental.")
+    parser.add_argument('--target', metavar='DATA_DIR',
+                        help="Empty data directory to restore the physical backup into.")
+    parser.add_argument('--week', help="ISO week (YYYYWW) to restore, defaults to the latest.")
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    restore_supabase_data()
\ No newline at end of file
+    args = parse_args()
+    if args.incremental:
+        if not args.target:
+            print("❌ --incremental needs --target DATA_DIR.")
+        else:
+            restore_incremental_backup(args.incremental, args.target, args.week)
+    else:
+        restore_supabase_data(args.file, args.yes, args.always_clean)
\ No newline at end of file
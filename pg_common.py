@@ -0,0 +1,82 @@
+"""Settings and helpers shared by direct_backup.py and direct_restore.py."""
+import os
+import shutil
+from dotenv import load_dotenv
+
+# Loaded here too, since the settings below are read at import
+load_dotenv()
+
+# --- Configuration ---
+# Schemas managed by Supabase that should NOT be included in a complete backup.
+# Override with a comma-separated EXCLUDED_SCHEMAS in .env. The restore ignores
+# the same schemas when checking whether the target is empty.
+EXCLUDED_SCHEMAS = tuple(
+    schema.strip()
+    for schema in os.getenv('EXCLUDED_SCHEMAS', 'auth,storage,realtime,supabase_functions,supabase_migrations').split(',')
+    if schema.strip()
+)
+# Only the last bytes of a failed tool's stderr are decoded and shown
+STDERR_TAIL_BYTES = 4096
+# Written by direct_backup.py --incremental next to the weekly backup chains
+INCREMENTAL_MANIFEST = 'manifest.json'
+# Restore in one transaction and stop at the first error, so a failed restore
+# leaves nothing behind. Applies to direct_restore.py and to PIPE_TO copies.
+# Off by default: on Supabase, statements touching objects owned by
+# supabase_admin fail harmlessly and would roll back the whole restore.
+RESTORE_SINGLE_TRANSACTION = os.getenv('RESTORE_SINGLE_TRANSACTION', '').lower() in ('1', 'true', 'yes')
+# Where to look for the PostgreSQL client tools when they're not on PATH
+PG_BIN_DIRS = [
+    '/opt/homebrew/opt/postgresql@15/bin',
+    '/usr/local/opt/postgresql@15/bin',
+    '/usr/lib/postgresql/15/bin',
+]
+# --- End Configuration ---
+
+def find_pg_tool(name):
+    """Locate a PostgreSQL client tool on PATH, falling back to well-known install prefixes."""
+    path = shutil.which(name)
+    if path:
+        return path
+    for bin_dir in PG_BIN_DIRS:
+        candidate = os.path.join(bin_dir, name)
+        if os.path.exists(candidate):
+            return candidate
+    return name
+
+# Resolved once at import instead of probing the filesystem on every call
+PSQL_PATH = find_pg_tool('psql')
+PG_RESTORE_PATH = find_pg_tool('pg_restore')
+PIGZ_PATH = shutil.which('pigz')
+
+def build_env(config, app_name):
+    """Build the minimal environment for the PostgreSQL client tools.
+
+    Only the variables the tools need are passed on, instead of copying the
+    whole process environment for every subprocess.
+    """
+    env = {
+        'PGPASSWORD': config['password'],
+        'PGSSLMODE': config['sslmode'],
+        'PGAPPNAME': app_name,
+        'PATH': os.environ.get('PATH', ''),
+        'HOME': os.environ.get('HOME', ''),
+    }
+    # Windows needs SYSTEMROOT to initialise its networking stack
+    if 'SYSTEMROOT' in os.environ:
+        env['SYSTEMROOT'] = os.environ['SYSTEMROOT']
+    return env
+
+def connection_args(config, dbname='postgres'):
+    """Return the connection flags shared by the PostgreSQL client tools."""
+    args = [
+        f'--host={config["host"]}',
+        f'--port={config["port"]}',
+        f'--username={config["user"]}',
+    ]
+    if dbname:
+        args.append(f'--dbname={dbname}')
+    return args
+
+def decode_tail(output):
+    """Decode the end of a tool's byte output for display, tolerating non-UTF-8 locales."""
+    return output[-STDERR_TAIL_BYTES:].decode('utf-8', errors='replace')
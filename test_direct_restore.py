@@ -0,0 +1,66 @@
+import io
+import unittest
+
+from direct_restore import copy_without_clean
+
+
+class CapturingPipe(io.BytesIO):
+    """Stands in for psql's stdin; keeps what was written after copy_without_clean closes it."""
+
+    def close(self):
+        self.captured = self.getvalue()
+        super().close()
+
+
+def strip_clean(dump):
+    dest = CapturingPipe()
+    copy_without_clean(io.BytesIO(dump), dest)
+    return dest.captured
+
+
+class CopyWithoutCleanTest(unittest.TestCase):
+    def test_drops_leading_drop_statements(self):
+        dump = (
+            b"SET statement_timeout = 0;\n"
+            b"ALTER TABLE IF EXISTS ONLY public.b DROP CONSTRAINT IF EXISTS b_a_fkey;\n"
+            b"DROP TABLE IF EXISTS public.a;\n"
+            b"DROP SCHEMA IF EXISTS app;\n"
+            b"DROP EXTENSION IF EXISTS pg_graphql;\n"
+            b"CREATE TABLE public.a (id integer);\n"
+        )
+        self.assertEqual(strip_clean(dump), (
+            b"SET statement_timeout = 0;\n"
+            b"DROP SCHEMA IF EXISTS app;\n"
+            b"DROP EXTENSION IF EXISTS pg_graphql;\n"
+            b"CREATE TABLE public.a (id integer);\n"
+        ))
+
+    def test_filters_each_part_of_a_joined_dump(self):
+        dump = (
+            b"CREATE TABLE public.a (id integer);\n"
+            b"-- PostgreSQL database dump complete\n"
+            b"SET statement_timeout = 0;\n"
+            b"DROP TABLE IF EXISTS app.b;\n"
+            b"CREATE TABLE app.b (id integer);\n"
+        )
+        self.assertNotIn(b"DROP TABLE", strip_clean(dump))
+
+    def test_copy_data_is_never_filtered(self):
+        # A data row that looks like the trailer must not restart filtering
+        dump = (
+            b"CREATE TABLE public.notes (body text);\n"
+            b"COPY public.notes (body) FROM stdin;\n"
+            b"DROP TABLE users\n"
+            b"-- PostgreSQL database dump complete\n"
+            b"DROP TABLE users\n"
+            b"ALTER TABLE x DROP COLUMN y\n"
+            b"\\.\n"
+            b"COPY public.other (body) FROM stdin;\n"
+            b"DROP this row too\n"
+            b"\\.\n"
+        )
+        self.assertEqual(strip_clean(dump), dump)
+
+
+if __name__ == '__main__':
+    unittest.main()